@@ -1,15 +1,44 @@
 #!env python3
 from pathlib import Path
+import functools
+import json
+import multiprocessing
+import os
+import re
 import shlex
+import shutil
 import subprocess
 import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Optional, Sequence, Union
 
 from dataclasses import dataclass
 
 CMD = Sequence[Union[str, Path]]
 
+MCU_SERIES = [
+    "stm8s003",
+    "stm8s103",
+    "stm8s105",
+    "stm32c0x",
+    "stm32f0x",
+    "stm32f1x",
+    "stm32f2x",
+    "stm32f3x",
+    "stm32f4x",
+    "stm32f7x",
+    "stm32g0x",
+    "stm32g4x",
+    "stm32h7x",
+]
+_PREFIX_TO_SERIES = {
+    (s[:-1] if s.endswith("x") else s): s for s in MCU_SERIES
+}
+_SERIES_RE = re.compile(
+    "^(" + "|".join(sorted(_PREFIX_TO_SERIES, key=len, reverse=True)) + ")"
+)
+
 
 class NotFoundException(Exception):
     pass
@@ -19,10 +48,65 @@ def print_cmd(cmd: CMD):
     print(shlex.join(str(c) for c in cmd))
 
 
+def run_cmd(cmd: CMD):
+    proc = subprocess.Popen(
+        [str(c) for c in cmd],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=0,
+    )
+    assert proc.stdout is not None
+    fd = proc.stdout.fileno()
+    while True:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            break
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, [str(c) for c in cmd])
+
+
+PATH_CACHE = Path("~/.cache/flash-mcu/paths.json").expanduser()
+
+
+def _load_path_cache() -> dict[str, str]:
+    try:
+        with open(PATH_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    # entries resolved under a different PATH may no longer be the right match
+    if cache.get("path") != os.environ.get("PATH", ""):
+        return {}
+    entries = cache.get("entries")
+    return entries if isinstance(entries, dict) else {}
+
+
+def _save_path_cache(entries: dict[str, str]):
+    cache = {"path": os.environ.get("PATH", ""), "entries": entries}
+    tmp_path = PATH_CACHE.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        PATH_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, PATH_CACHE)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=None)
 def which(exe: str) -> Path:
-    p = subprocess.run(["which", exe], capture_output=True, text=True)
-    if p.returncode == 0:
-        return Path(p.stdout.strip())
+    cache = _load_path_cache()
+    cached = cache.get(exe)
+    if cached and os.path.exists(cached):
+        return Path(cached)
+    p = shutil.which(exe)
+    if p:
+        cache[exe] = p
+        _save_path_cache(cache)
+        return Path(p)
     raise NotFoundException(f"cannot found {exe}")
 
 
@@ -34,36 +118,62 @@ class Args:
     port: Optional[str]
     start: Optional[str]
     dryrun: bool
+    check: bool = False
 
 
+@functools.lru_cache(maxsize=None)
 def get_platformio_package_path(package: str) -> Path:
     package_path = Path("~", ".platformiopackages", package).expanduser()
-    if not package_path.exists():
+    try:
+        os.stat(package_path)
+    except FileNotFoundError:
         raise NotFoundException(f"platform package {package} not found")
     return package_path
 
 
-def get_platformio_package_bin_path(package: str, executable: str) -> Path:
-    package_path = get_platformio_package_path(package)
+def _bin_path(package_path: Path, executable: str) -> Path:
     bin_path = package_path.joinpath("bin", executable)
-    if not bin_path.exists():
+    try:
+        os.stat(bin_path)
+    except FileNotFoundError:
         raise NotFoundException(
-            f"PlatformIO package {package} does not have {executable}"
+            f"PlatformIO package {package_path.name} does not have {executable}"
         )
     return bin_path
 
 
+@functools.lru_cache(maxsize=None)
 def detect_openocd_path() -> tuple[Path, Path]:
-    if (
-        Path("/usr/local/bin/openocd").exists()
-        and Path("/usr/local/share/openocd").exists()
-    ):
+    try:
+        os.stat("/usr/local/bin/openocd")
+    except FileNotFoundError:
+        pass
+    else:
         return Path("/usr/local/bin/openocd"), Path("/usr/local/share/openocd")
 
-    return (
-        get_platformio_package_path("tool-openocd"),
-        get_platformio_package_bin_path("tool-openocd", "openocd"),
-    )
+    package_path = get_platformio_package_path("tool-openocd")
+    return _bin_path(package_path, "openocd"), package_path
+
+
+_PROGRAM_BUILDERS = {
+    ".bin": lambda firmware, start: f"program {firmware} exit {start}",
+    ".elf": lambda firmware, start: f"program {firmware} verify reset exit",
+    ".hex": lambda firmware, start: f"program {firmware} verify reset exit",
+}
+
+
+def _openocd_cmd(
+    openocd_bin: Path, openocd_root: Path, tool: str, series: str, program: str
+) -> CMD:
+    return [
+        openocd_bin,
+        "-f",
+        openocd_root.joinpath("scripts", "interface", f"{tool}.cfg"),
+        "-f",
+        openocd_root.joinpath("scripts", "target", f"{series}.cfg"),
+        "-c",
+        program,
+    ]
 
 
 def flash_stm32(args: Args):
@@ -82,70 +192,28 @@ def flash_stm32(args: Args):
         tool = "cmsis-dap"
     print(f"tool using {tool}")
 
-    mcu_series = [
-        "stm8s003",
-        "stm8s103",
-        "stm8s105",
-        "stm32c0x",
-        "stm32f0x",
-        "stm32f1x",
-        "stm32f2x",
-        "stm32f3x",
-        "stm32f4x",
-        "stm32f7x",
-        "stm32g0x",
-        "stm32g4x",
-        "stm32h7x",
-    ]
-    detected_mcu_series = ""
-    for series in mcu_series:
-        if series.endswith("x"):
-            series_start = series[:-1]
-        else:
-            series_start = series
-        if mcu.startswith(series_start):
-            detected_mcu_series = series
-            break
+    m = _SERIES_RE.match(mcu)
+    detected_mcu_series = _PREFIX_TO_SERIES[m.group(1)] if m else ""
 
     if not detected_mcu_series:
         print(f"cannot support mcu {args.mcu}")
         sys.exit()
 
     print(detected_mcu_series)
-    if args.firmware_path.endswith(".bin"):
-        cmd: Sequence[Union[str, Path]] = [
-            openocd_bin,
-            "-f",
-            openocd_root.joinpath("scripts", "interface", f"{tool}.cfg"),
-            "-f",
-            openocd_root.joinpath("scripts", "target", f"{detected_mcu_series}.cfg"),
-            "-c",
-            f"program {args.firmware_path} exit {start}",
-        ]
-        print(shlex.join(str(c) for c in cmd))
-        if not args.dryrun:
-            subprocess.run(cmd, check=True)
-            pass
-        return
-    if args.firmware_path.endswith(".elf") or args.firmware_path.endswith(".hex"):
-        cmd = [
-            openocd_bin,
-            "-f",
-            openocd_root.joinpath("scripts", "interface", f"{tool}.cfg"),
-            "-f",
-            openocd_root.joinpath("scripts", "target", f"{detected_mcu_series}.cfg"),
-            "-c",
-            f"program {args.firmware_path} verify reset exit",
-        ]
-        print(shlex.join(str(c) for c in cmd))
-        if not args.dryrun:
-            subprocess.run(cmd, check=True)
-            pass
-        return
-    print(f"unknown firmware {args.firmware_path}")
-    sys.exit(1)
+    suffix = Path(args.firmware_path).suffix.lower()
+    build_program = _PROGRAM_BUILDERS.get(suffix)
+    if build_program is None:
+        print(f"unknown firmware {args.firmware_path}")
+        sys.exit(1)
+    program = build_program(args.firmware_path, start)
+
+    cmd = _openocd_cmd(openocd_bin, openocd_root, tool, detected_mcu_series, program)
+    print_cmd(cmd)
+    if not args.dryrun:
+        run_cmd(cmd)
 
 
+@functools.lru_cache(maxsize=None)
 def detect_esptool_path() -> list[Path]:
     if Path("~/.platformio/packages/tool-esptoolpy").expanduser().exists():
         python_path = Path("~/.platformio/penv/bin/python").expanduser()
@@ -176,62 +244,154 @@ def flash_esp32(args: Args):
     print_cmd(cmd)
 
     if not args.dryrun:
-        subprocess.run(cmd, check=True)
-        pass
+        run_cmd(cmd)
     return
 
 
+_FAMILIES = (
+    ("stm32", flash_stm32),
+    ("esp32", flash_esp32),
+)
+
+
 def flash_mcu(args: Args):
     mcu = args.mcu.lower()
-    if mcu.startswith("stm32"):
-        flash_stm32(args)
-        return
-    if mcu.startswith("esp32"):
-        flash_esp32(args)
-        return
+    for prefix, flash in _FAMILIES:
+        if mcu.startswith(prefix):
+            flash(args)
+            return
 
     print(f"mcu {mcu} is not supported")
     sys.exit(1)
 
 
-def parse_args() -> Args:
+def _flash_locked(args: Args, lock) -> None:
+    with lock:
+        flash_mcu(args)
+
+
+def flash_many(args_list: list[Args]):
+    manager = multiprocessing.Manager()
+    # one lock per adapter/port so two jobs never contend for the same probe
+    locks: dict[tuple[Optional[str], Optional[str]], object] = {}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {}
+        for args in args_list:
+            key = (args.tool, args.port)
+            if key not in locks:
+                locks[key] = manager.Lock()
+            future = executor.submit(_flash_locked, args, locks[key])
+            futures[future] = args
+        for future in as_completed(futures):
+            args = futures[future]
+            try:
+                future.result()
+                print(f"[{args.mcu} {args.firmware_path}] done")
+            except SystemExit as e:
+                # the flash functions report errors with sys.exit
+                print(f"[{args.mcu} {args.firmware_path}] failed: exit {e.code}")
+                failed += 1
+            except Exception as e:
+                print(f"[{args.mcu} {args.firmware_path}] failed: {e}")
+                failed += 1
+    if failed:
+        print(f"{failed}/{len(args_list)} jobs failed")
+        sys.exit(1)
+
+
+def load_batch(batch_path: str, dryrun: bool, check: bool) -> list[Args]:
+    with open(batch_path) as f:
+        jobs = json.load(f)
+    return [
+        Args(
+            mcu=job["mcu"],
+            firmware_path=job["firmware"],
+            start=job.get("start"),
+            tool=job.get("tool"),
+            port=job.get("port"),
+            dryrun=dryrun,
+            check=check,
+        )
+        for job in jobs
+    ]
+
+
+def parse_args() -> list[Args]:
     parser = argparse.ArgumentParser(
         prog="flash-mcu.py",
         description="openocd wrapper for PlatformIO user",
         epilog="Text at the bottom of help",
     )
 
-    parser.add_argument("mcu", help="mcu name", type=str)
-    parser.add_argument("firmware", help="firmware path (.bin/.elf/.hex)", type=str)
+    parser.add_argument("mcu", help="mcu name", type=str, nargs="?")
+    parser.add_argument(
+        "firmware", help="firmware path (.bin/.elf/.hex)", type=str, nargs="?"
+    )
     parser.add_argument("-s", "--start", help="start address", type=str, required=False)
     parser.add_argument("-t", "--tool", help="flash tool", type=str, required=False)
     parser.add_argument("-p", "--port", help="port", type=str, required=False)
+    parser.add_argument(
+        "-b", "--batch", help="JSON file with a list of flash jobs", type=str,
+        required=False,
+    )
     parser.add_argument("-d", "--dryrun", help="dry run", action='store_true')
+    parser.add_argument(
+        "-c", "--check",
+        help="check that the firmware exists before invoking the flash tool",
+        action='store_true',
+    )
 
     args = parser.parse_args()
 
-    return Args(
-        mcu=args.mcu,
-        firmware_path=args.firmware,
-        start=args.start,
-        tool=args.tool,
-        port=args.port,
-        dryrun=args.dryrun,
-    )
+    if args.batch:
+        try:
+            return load_batch(args.batch, args.dryrun, args.check)
+        except OSError as e:
+            parser.error(f"cannot read batch file {args.batch}: {e}")
+        except ValueError as e:
+            parser.error(f"batch file {args.batch} is not valid JSON: {e}")
+        except KeyError as e:
+            parser.error(f"batch job is missing required field {e}")
+
+    if not args.mcu or not args.firmware:
+        parser.error("mcu and firmware are required without --batch")
+
+    return [
+        Args(
+            mcu=args.mcu,
+            firmware_path=args.firmware,
+            start=args.start,
+            tool=args.tool,
+            port=args.port,
+            dryrun=args.dryrun,
+            check=args.check,
+        )
+    ]
 
 
 def main():
-    args = parse_args()
+    args_list = parse_args()
 
-    if not Path(args.firmware_path).exists():
-        print(f"firmware {args.firmware_path} does not exist")
-        sys.exit(1)
+    if any(a.check for a in args_list):
+        # the flash tool opens the firmware anyway; --check trades one extra
+        # stat per unique file for a friendlier error message
+        for firmware_path in {a.firmware_path for a in args_list}:
+            if not Path(firmware_path).exists():
+                print(f"firmware {firmware_path} does not exist")
+                sys.exit(1)
 
     try:
-        flash_mcu(args)
+        if len(args_list) == 1:
+            flash_mcu(args_list[0])
+        else:
+            flash_many(args_list)
     except NotFoundException as e:
         print(e)
         sys.exit(1)
+    except subprocess.CalledProcessError as e:
+        print(e)
+        sys.exit(e.returncode)
 
 
 if __name__ == "__main__":